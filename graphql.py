@@ -12,7 +12,10 @@ import argparse
 import datetime
 import itertools
 import json as _json
+import math
 import os
+import random
+import re
 import sys
 import time
 import warnings
@@ -46,10 +49,7 @@ class MultiIterContext:
             context.__exit__(*args)
 
     def __iter__(self):
-        return itertools.chain.from_iterable(self.contexts)
-
-    def __len__(self):
-        return sum(1 for _ in self)
+        return itertools.chain(*self.contexts)
 
 
 def graphql_help(quitter=True):
@@ -113,16 +113,31 @@ parser.add_argument("-c","--concurrency", metavar="COUNT", action="store", dest=
 parser.add_argument("-r", "--retries", metavar="RETRIES", action="store", dest="retries", help="Number of retries if an item gets a 429 (Too Many Requests) response from the server. 0 means don't retry at all. Default is 3",
         default=3, type=int)
 parser.add_argument("-s", "--stop", action="store_true", dest="stop", help="Stop processing after hitting a failure (note, the program will wait for a response from the server for already-queued items)")
+parser.add_argument("--dedup", action="store_true", dest="dedup", help="When reading queries from a file, only send each distinct query once")
 parser.add_argument("-d", "--disable-logging", action="store_false", dest="do_logging", help="Disable log file and only output to stdout")
 parser.add_argument('IDs', metavar="IDs|FILE", nargs="*", type=id_type, help="If using IDs, you can specify a range like 1-8, individual like 4 8 16 or a mix like 1-8 12 24. If using a file to read queries from, put the filename")
 args = parser.parse_args()
 
 def get_ids(ids):
+    out = []
     for item in ids:
         if isinstance(item, range):
-            yield from item
+            out.extend(item)
+        else:
+            out.append(item)
+    return out
+
+def split_query(query):
+    "Split a query on its %i placeholders, unescaping %% to % as %-formatting did"
+    parts = ['']
+    for token in re.split(r'(%%|%i)', query):
+        if token == '%i':
+            parts.append('')
+        elif token == '%%':
+            parts[-1] += '%'
         else:
-            yield item
+            parts[-1] += token
+    return parts
 
 if args.usage:
     graphql_help()
@@ -133,7 +148,8 @@ if not args.IDs:
 def ctrlc(etype, value, tb, dump_path):
     "Ctrl+C handler"
     if isinstance(value, KeyboardInterrupt):
-        state.stop_immediately = True
+        if state.stop_event is not None:
+            state.stop_event.set()
     elif isinstance(value, Exception):
         name_to_show = ''
         for char in value.__class__.__name__:
@@ -145,7 +161,11 @@ def ctrlc(etype, value, tb, dump_path):
         message += f'Crash dump saved to: {dump_path}'
         print(message, file=sys.stderr)
         if log_handler is not None:
+            # Write out any responses still waiting on the log writer first
+            if globals().get('state') is not None and state.log_queue is not None:
+                drain(state.log_queue, log_handler)
             print(message, file=log_handler)
+            log_handler.flush()
         sys.exit(1)
 
 def error():
@@ -182,11 +202,11 @@ if concurrent_requests > 12:
 # Ctrl+C handling
 crashreport.inject_excepthook(ctrlc)
 
-varList = list(get_ids(args.IDs))
+varList = get_ids(args.IDs)
 
 if args.do_logging:
     try:
-        log_handler = open(args.logfile, "w", buffering=1)
+        log_handler = open(args.logfile, "w")
         print(f"Logging to", args.logfile)
     except:
         print(f"Couldn't open {args.logfile} for writing; aborting!")
@@ -194,17 +214,20 @@ if args.do_logging:
 else:
     log_handler = None
 
-uniform_type = type(varList[0])
-for id in varList:
-    if not isinstance(id, uniform_type):
-        if uniform_type == int:
+# id_type() returns a range for IDs and a str for files, so checking the
+# arguments themselves is enough (and much cheaper than checking every ID)
+arg_type = type(args.IDs[0])
+for arg in args.IDs:
+    if type(arg) is not arg_type:
+        if arg_type is range:
             type_name = 'IDs'
-        elif uniform_type == str:
+        elif arg_type is str:
             type_name = 'files'
         else:
-            type_name = uniform_type.__qualname__
+            type_name = arg_type.__qualname__
         print('Arguments are not all', type_name)
         exit(1)
+uniform_type = int if arg_type is range else str
 
 if uniform_type == int:
     totalIDs = len(varList)
@@ -221,129 +244,278 @@ if uniform_type == int:
                 break
             query += line
 
-    if '%i' not in query:
+    query_parts = split_query(query)
+    if len(query_parts) < 2:
         print("There was no %i in the query... perhaps you should run it via GraphiQL")
         sys.exit(1)
-elif uniform_type == str:
-    totalIDs = 0
-    line_count = 0
-    with MultiIterContext(*(open(file, encoding='utf-8') for file in varList)) as fps:
-        for line in fps:
-            totalIDs += bool(line.strip())
-            line_count += 1
-    padding = len(str(line_count))
 
 
 import asyncio
-import types
 
 import aiohttp
 import colorama
 
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+if orjson is not None:
+    def query_body(queryText):
+        return orjson.dumps({'query': queryText})
+else:
+    def query_body(queryText):
+        return b'{"query":' + _json.dumps(queryText).encode() + b'}'
+
 max_requests = 1 if args.stop else args.retries + 1
-responseList = []
-lineList = []
-
-async def doQuery(state, sess: aiohttp.ClientSession, queryText, id):
-    global responseList
-    while state.activeTasks >= concurrent_requests:
-        await asyncio.sleep(0)
-
-    async def internal():
-        state.activeTasks += 1
-        async with sess.post(URI, json={'query': queryText}) as resp:
-            state.activeTasks -= 1
-            if resp.status != 429:
+RED = ('\u001b[31;1m', '\u001b[0m')
+YELLOW = ('\u001b[33;1m', '\u001b[0m')
+NO_COLOR = ('', '')
+MAX_BACKOFF = 60  # seconds
+MAX_RETRY_AFTER = 3600  # seconds; guards against absurd Retry-After headers
+
+
+class State:
+    __slots__ = ('doneTasks', 'successes', 'stop_event', 'responses', 'print_queue', 'log_queue')
+
+    def __init__(self) -> None:
+        self.doneTasks = 0
+        self.successes = 0
+        self.responses = set()
+        # The event and queues are created in main(), once the event loop is running
+        self.stop_event = None
+        self.print_queue = None
+        self.log_queue = None
+
+
+def make_query_fn(state: State, sess: aiohttp.ClientSession, uri, totalIDs, padding, stop, duplicate_counts):
+    "Build doQuery with everything that stays fixed for the run bound as locals"
+    _post = sess.post
+    _print = state.print_queue.put_nowait
+    _log = None if state.log_queue is None else state.log_queue.put_nowait
+    _responses = state.responses
+    _stop_event = state.stop_event
+    _dumps = _json.dumps
+
+    async def doQuery(queryText, id):
+        retry_after = None
+        # With --dedup, say how many other input lines this query stands in for
+        dups = f", +{duplicate_counts[id]} duplicates" if id in duplicate_counts else ''
+
+        async def internal():
+            nonlocal retry_after
+            async with _post(uri, data=query_body(queryText)) as resp:
+                if resp.status != 429:
+                    state.doneTasks += 1
+                else:
+                    retry_after = resp.headers.get('Retry-After')
+                doneTasks = state.doneTasks
+                _responses.add(id)
+                error_code = resp.status
+                try:
+                    json = await resp.json()
+                except (ContentTypeError, UnicodeDecodeError):
+                    json = await resp.text(errors='replace')
+                    failed_json = True
+                else:
+                    failed_json = False
+                if resp.status != 200:
+                    color = RED
+                    detail = f"Error: response code on query '{queryText}' was {resp.status} "
+                elif failed_json:
+                    color = RED
+                    detail = f"Error: unable to decode JSON on query '{queryText}' "
+                    error_code = -1
+                elif 'errors' in json:
+                    color = RED
+                    detail = f"Got error response on query '{queryText}' : "
+                    error_code = -1
+                else:
+                    color = NO_COLOR
+                    detail = ''
+                message = f"Processed {id:<{padding}} ({doneTasks} of {totalIDs} complete{dups}) - {detail}{_dumps(json)}"
+                _print(f'{color[0]}{message}{color[1]}')
+                if _log is not None:
+                    _log(message)
+                if error_code == 200:
+                    state.successes += 1
+                return error_code
+        backoff = 1
+        for tries in range(max_requests):
+            if _stop_event.is_set():
                 state.doneTasks += 1
-            message = f"Processed {id:<{padding}} ({state.doneTasks} of {totalIDs} complete) - "
-            responseList.append(id)
-            error_code = resp.status
-            try:
-                json = await resp.json()
-            except (ContentTypeError, UnicodeDecodeError):
-                json = await resp.text(errors='replace')
-                failed_json = True
-            else:
-                failed_json = False
-            if resp.status != 200:
-                color = ('\u001b[31;1m', '\u001b[0m')
-                message += f"Error: response code on query '{queryText}' was {resp.status} "
-            elif failed_json:
-                color = ('\u001b[31;1m', '\u001b[0m')
-                message += f"Error: unable to decode JSON on query '{queryText}' "
-                error_code = -1
-            elif 'errors' in json:
-                color = ('\u001b[31;1m', '\u001b[0m')
-                message += f"Got error response on query '{queryText}' : "
-                error_code = -1
+                return -1
+            resp_code = await internal()
+            if _stop_event.is_set():
+                return resp_code
+            if stop and resp_code != 200:
+                _stop_event.set()
+                return -1
+            if resp_code == 429:
+                if tries + 1 < max_requests:
+                    # Honor the server's Retry-After when it gives a number of seconds;
+                    # otherwise jitter the backoff so tasks don't all retry at once
+                    try:
+                        delay = float(retry_after)
+                    except (TypeError, ValueError):
+                        delay = None
+                    clamped = ''
+                    if delay is None or not math.isfinite(delay) or delay < 0:
+                        delay = min(backoff * random.uniform(0.5, 1.5), MAX_BACKOFF)
+                    elif delay > MAX_RETRY_AFTER:
+                        clamped = f' (server asked for {delay:.0f})'
+                        delay = MAX_RETRY_AFTER
+                    message = ' '*10 + f'{id:<{padding}} failed ({max_requests - tries} retry(s) remaining). Retrying in {delay:.1f} seconds{clamped}...'
+                    _print(YELLOW[0] + message + YELLOW[1])
+                    if _log is not None:
+                        _log(message)
+                    # Wake up early if something else stops the run while we wait
+                    try:
+                        await asyncio.wait_for(_stop_event.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    backoff = min(backoff * 2, MAX_BACKOFF)
             else:
-                color = ('', '')
-            message += _json.dumps(json)
-            print(f'%s{message.replace("%", "%%")}%s' % color)
-            if log_handler is not None:
-                print(message, file=log_handler)
-            return error_code
-    backoff = 1
-    for tries in range(max_requests):
-        if state.stop_immediately:
-            state.doneTasks += 1
-            return -1
-        resp_code = await internal()
-        if state.stop_immediately:
-            return resp_code
-        if args.stop and resp_code != 200:
-            state.stop_immediately = True
-            return -1
-        if resp_code == 429:
-            if tries + 1 < max_requests:
-                message = ' '*10 + f'{id:<{padding}} failed ({max_requests - tries} retry(s) remaining). Retrying in {backoff} seconds...'
-                print('\u001b[33;1m' + message + '\u001b[0m')
-                if log_handler is not None:
-                    print(message, file=log_handler)
-                await asyncio.sleep(backoff)
-                backoff *= 2
-        else:
-            return resp_code
-    state.doneTasks += 1
-    message = ' '*10 + f'{id:<6} failed {max_requests} times. It will not be retried.'
-    print('\u001b[31;1m' + message + '\u001b[0m')
-    if log_handler is not None:
-        print(message, file=log_handler)
-    return -1
-
-
-state = types.SimpleNamespace()
+                return resp_code
+        state.doneTasks += 1
+        message = ' '*10 + f'{id:<6} failed {max_requests} times. It will not be retried.'
+        _print(RED[0] + message + RED[1])
+        if _log is not None:
+            _log(message)
+        return -1
+
+    return doQuery
+
+
+async def worker(state: State, doQuery, queue: asyncio.Queue):
+    while True:
+        queryText, id = await queue.get()
+        try:
+            await doQuery(queryText, id)
+        except Exception as e:
+            # e.g. a connection error, or a JSON body that doesn't parse
+            message = ' '*10 + f'{id} failed on query \'{queryText}\': {e.__class__.__name__}: {e}'
+            state.print_queue.put_nowait(RED[0] + message + RED[1])
+            if state.log_queue is not None:
+                state.log_queue.put_nowait(message)
+        finally:
+            queue.task_done()
+
+
+async def batch_writer(queue: asyncio.Queue, fp, interval):
+    "Write queued lines to fp in batches, flushing at most every `interval` seconds"
+    while True:
+        lines = [await queue.get()]
+        while not queue.empty():
+            lines.append(queue.get_nowait())
+        fp.write('\n'.join(lines) + '\n')
+        fp.flush()
+        await asyncio.sleep(interval)
+
+
+def drain(queue: asyncio.Queue, fp):
+    "Write out whatever is left in a batch_writer queue"
+    lines = []
+    while not queue.empty():
+        lines.append(queue.get_nowait())
+    if lines:
+        fp.write('\n'.join(lines) + '\n')
+        fp.flush()
+
+
+state = State()
 async def main():
-    tasks = []
-    state.doneTasks = 0
-    state.activeTasks = 0
-    state.stop_immediately = False
-
-    global lineList
+    if hasattr(asyncio, 'eager_task_factory'):  # Python 3.12+
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+    queue = asyncio.Queue()
+    state.stop_event = asyncio.Event()
+    state.print_queue = asyncio.Queue()
+    state.log_queue = None if log_handler is None else asyncio.Queue()
+
+    global totalIDs, padding
+    submitted = set()
+    duplicates = {}
+
+    if uniform_type == int:
+        for varNumber in varList:
+            queryText = str(varNumber).join(query_parts)
+            queue.put_nowait((queryText, varNumber))
+    else:
+        # Read the files in a single pass, counting lines as they are queued
+        line_no = 0
+        with MultiIterContext(*(open(file, encoding='utf-8') for file in varList)) as fps:
+            for (line_no, line) in enumerate(fps, 1):
+                line = line.strip()
+                # print(f"Line {line_no} - {line}")
+                if line:
+                    submitted.add(line_no)
+                    if args.dedup:
+                        # Only the first line with a given query is sent
+                        if line in duplicates:
+                            duplicates[line].append(line_no)
+                            continue
+                        duplicates[line] = [line_no]
+                    queue.put_nowait((line, line_no))
+        totalIDs = queue.qsize()
+        padding = len(str(line_no))
 
     startTime = datetime.datetime.now()
     message = f'Processing {totalIDs} lines/IDs with {concurrent_requests} concurrent {"request" if concurrent_requests == 1 else "requests"} on {URI} at {startTime}'
     print(message)
     if log_handler is not None:
         print(message, file=log_handler)
-    async with aiohttp.ClientSession(headers={
-        'Authorization': f'Bearer {BEARER_TOKEN}'
+    connector = aiohttp.TCPConnector(
+        limit=concurrent_requests,
+        limit_per_host=concurrent_requests,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        # Only needed before CPython fixed the SSL transport leak (3.12.8 and
+        # 3.13.1); newer aiohttp warns about it on the fixed versions
+        enable_cleanup_closed=(
+            sys.version_info < (3, 12, 8)
+            or (3, 13, 0) <= sys.version_info < (3, 13, 1)
+        ),
+    )
+    async with aiohttp.ClientSession(connector=connector, headers={
+        'Authorization': f'Bearer {BEARER_TOKEN}',
+        'Content-Type': 'application/json',
     }) as sess:
-        if uniform_type == int:
-            for varNumber in varList:
-                queryText = query % ((varNumber,) * query.count('%i'))
-                tasks.append(asyncio.create_task(doQuery(state, sess, queryText, varNumber)))
-        else:
-            with MultiIterContext(*(open(file, encoding='utf-8') for file in varList)) as fps:
-                for (i, line) in enumerate(fps):
-                    line = line.strip()
-                    lineList.append(i+1)
-                    # print(f"Line {i+1} - {line}")
-                    if line:
-                        tasks.append(asyncio.create_task(doQuery(state, sess, line, i + 1)))
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    successes = results.count(200)  # count the number of 200 OK http responses
+        print_task = asyncio.create_task(batch_writer(state.print_queue, sys.stdout, 0.05))
+        if state.log_queue is not None:
+            log_task = asyncio.create_task(batch_writer(state.log_queue, log_handler, 0.1))
+        try:
+            duplicate_counts = {lines[0]: len(lines) - 1 for lines in duplicates.values() if len(lines) > 1}
+            doQuery = make_query_fn(state, sess, URI, totalIDs, padding, args.stop, duplicate_counts)
+            workers = [asyncio.create_task(worker(state, doQuery, queue)) for _ in range(concurrent_requests)]
+            await queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            # Runs on Ctrl+C too, so every response that came back gets shown and
+            # logged. The writers only await between whole batches, so after
+            # cancel() the queues hold exactly what hasn't been written yet.
+            print_task.cancel()
+            drain(state.print_queue, sys.stdout)
+            if state.log_queue is not None:
+                log_task.cancel()
+                drain(state.log_queue, log_handler)
+
+    # A response to a deduplicated query covers every line it appeared on
+    for lines in duplicates.values():
+        if lines[0] in state.responses:
+            state.responses.update(lines[1:])
+
+    # Record which lines each deduplicated query stood in for, once, in the log
+    # (or on stdout when logging is disabled)
+    duplicate_summary = '\n'.join(
+        f"Line {lines[0]} also covered duplicate lines: " + ','.join([str(x) for x in lines[1:]])
+        for lines in duplicates.values() if len(lines) > 1
+    )
+    if duplicate_summary:
+        print(duplicate_summary, file=log_handler if log_handler is not None else sys.stdout)
+
+    successes = state.successes
 
     failures = set()
     if successes == totalIDs:
@@ -351,15 +523,11 @@ async def main():
     else:
         color = '\u001b[33;1m'
         if uniform_type == int:
-            for var in varList:
-                if var not in responseList:
-                    failures.add(var)
-            error_summary = "Never heard back from: " + ','.join([str(x) for x in sorted(list(failures))]).rstrip(",")
+            failures = set(varList) - state.responses
+            error_summary = "Never heard back from: " + ','.join([str(x) for x in sorted(failures)])
         else:
-            for var in lineList:
-                if var not in responseList:
-                    failures.add(var)
-            error_summary = "Never heard back from the following input lines: " + ','.join([str(x) for x in sorted(list(failures))]).rstrip(",")
+            failures = submitted - state.responses
+            error_summary = "Never heard back from the following input lines: " + ','.join([str(x) for x in sorted(failures)])
 
 
     message = f"{successes}/{totalIDs} requests succeeded"
@@ -369,15 +537,20 @@ async def main():
     if len(failures):
         message += f"\n{error_summary}"
     # message += f"\nLine count: {line_count}; totalIDs:{totalIDs} successes: {successes}"
-    # message += "\nLine List: " + ','.join([str(x) for x in lineList])
-    # message += "\nResponse List: " + ','.join([str(x) for x in responseList])
+    # message += "\nSubmitted Lines: " + ','.join([str(x) for x in sorted(submitted)])
+    # message += "\nResponse Set: " + ','.join([str(x) for x in sorted(state.responses)])
 
     print(color + message + '\u001b[0m')
     if log_handler is not None:
         print(message, file=log_handler)
 
 
-if sys.platform == 'win32':
-    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+try:
+    import uvloop
+except ModuleNotFoundError:
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 with colorama.colorama_text():
     asyncio.run(main())